@@ -1,10 +1,19 @@
+import re
 import sys
 import time
-import requests  # pip install requests
+import copy
+import logging
+import collections
+import threading
 from xml.etree.ElementTree import fromstring
 
+# requests, multiprocessing and the http client modules are imported where
+# they are first needed, to keep "import namecheap" fast for short scripts
+
 inPy3k = sys.version_info[0] == 3
 
+log = logging.getLogger(__name__)
+
 # http://developer.namecheap.com/docs/doku.php?id=overview:2.environments
 ENDPOINTS = {
     # To use
@@ -20,6 +29,30 @@ NAMESPACE = "http://api.namecheap.com/xml.response"
 DEFAULT_ATTEMPTS_COUNT = 1  # no retries
 DEFAULT_ATTEMPTS_DELAY = 0.1  # in seconds
 
+# default limits for the client side throttle as (calls, period in seconds),
+# Namecheap allows 50 calls per minute, 700 per hour and 8000 per day per account
+# https://www.namecheap.com/support/knowledgebase/article.aspx/9739/63/api-faq
+DEFAULT_THROTTLE_LIMITS = ((50, 60), (700, 3600), (8000, 86400))
+
+# largest page domains.getList will return, fewer pages means fewer round trips
+# https://www.namecheap.com/support/api/methods/domains/get-list/
+GETLIST_MAX_PAGE_SIZE = 100
+GETLIST_SORT_BY = ('NAME', 'NAME_DESC', 'EXPIREDATE', 'EXPIREDATE_DESC', 'CREATEDATE', 'CREATEDATE_DESC')
+
+# values Namecheap fills in for host records that are set without them
+DEFAULT_HOST_RECORD = {'MXPref': '10', 'TTL': '1800'}
+# record types whose Address is a hostname rather than an IP or URL
+HOSTNAME_RECORD_TYPES = ('CNAME', 'MX', 'NS', 'ALIAS')
+
+# errors after which ApiPool tries another account: '1' is a non 200 HTTP
+# response, which is how rate limiting shows up, the others are an invalid
+# ApiKey / disabled API access and a ClientIP that is not whitelisted
+POOL_FAILOVER_ERRORS = ('1', '1011102', '1011150')
+DEFAULT_POOL_COOLDOWN = 60  # in seconds
+
+# responses longer than this are cut short in the debug log
+DEFAULT_DEBUG_BODY_LIMIT = 2000  # in characters
+
 
 # https://www.namecheap.com/support/api/error-codes.aspx
 class ApiError(Exception):
@@ -29,21 +62,191 @@ class ApiError(Exception):
         self.text = text
 
 
+class Throttle(object):
+    """Token buckets limiting how many API calls can be made, one bucket per
+    (calls, period) pair in limits, and a call has to fit in all of them.
+    The buckets start full, so short bursts go through immediately. They only
+    know about calls made through this throttle since it was created, not
+    about other programs using the same account. Safe to share between
+    threads of one process."""
+    def __init__(self, limits=DEFAULT_THROTTLE_LIMITS):
+        self.limits = tuple((calls, period) for calls, period in limits)
+        self._lock = threading.Lock()
+        # [time of last refill, tokens left in each bucket...]
+        self._state = [time.time()] + [float(calls) for calls, period in self.limits]
+
+    def _refill(self, now):
+        elapsed = now - self._state[0]
+        self._state[0] = now
+        tokens = []
+        for i, (calls, period) in enumerate(self.limits):
+            self._state[i + 1] = min(float(calls), self._state[i + 1] + elapsed * calls / float(period))
+            tokens.append(self._state[i + 1])
+        return tokens
+
+    def remaining(self):
+        """Number of calls that can be made right now without waiting"""
+        with self._lock:
+            return min(self._refill(time.time()))
+
+    def acquire(self):
+        """Take one call from the budget, sleeping until one is available"""
+        while True:
+            with self._lock:
+                tokens = self._refill(time.time())
+                if min(tokens) >= 1:
+                    for i in range(len(tokens)):
+                        self._state[i + 1] = tokens[i] - 1
+                    return
+                wait = max((1 - left) * period / float(calls)
+                           for left, (calls, period) in zip(tokens, self.limits) if left < 1)
+            time.sleep(wait)
+
+
+class SharedThrottle(Throttle):
+    """Throttle whose budget lives in shared memory, so that worker
+    processes started from this one all draw from the same budget.
+    Pass it to child processes when they are created (for example as
+    Pool initargs), it can not be pickled afterwards."""
+    def __init__(self, limits=DEFAULT_THROTTLE_LIMITS):
+        import multiprocessing
+        Throttle.__init__(self, limits)
+        self._state = multiprocessing.Array('d', self._state)
+        self._lock = self._state.get_lock()
+
+
+class RequestsTransport(object):
+    """Sends API calls with requests.post, the default transport.
+    requests is only imported when the first call is made."""
+    def __call__(self, url, params=None, data=None):
+        import requests  # pip install requests
+        return requests.post(url, params=params, data=data)
+
+
+class HTTPTransport(object):
+    """Sends API calls using only the standard library, keeping one
+    connection open per thread so that consecutive calls skip the TCP and
+    TLS handshakes. Use it when requests is not available:
+
+    api = Api(username, api_key, username, ip_address, transport=HTTPTransport())
+    """
+    class Response(object):
+        def __init__(self, status_code, text, url):
+            self.status_code = status_code
+            self.text = text
+            self.url = url
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # open connections stay behind when the Api is copied to another process
+        return {'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connection(self, scheme, host):
+        if inPy3k:
+            from http.client import HTTPConnection, HTTPSConnection
+        else:
+            from httplib import HTTPConnection, HTTPSConnection
+        key = (scheme, host)
+        if getattr(self._local, 'key', None) != key:
+            self.close()
+            connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+            self._local.connection = connection_class(host, timeout=self.timeout)
+            self._local.key = key
+        return self._local.connection
+
+    def close(self):
+        """Closes the connection of the calling thread, if it has one"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+        self._local.key = None
+
+    @classmethod
+    def _is_dropped_connection(cls, error):
+        """Whether the error means the server had closed the connection
+        before the request was sent"""
+        if inPy3k:
+            from http.client import RemoteDisconnected
+            return isinstance(error, (RemoteDisconnected, BrokenPipeError, ConnectionResetError))
+        import errno
+        from httplib import BadStatusLine
+        return isinstance(error, BadStatusLine) or getattr(error, 'errno', None) in (errno.EPIPE, errno.ECONNRESET)
+
+    def __call__(self, url, params=None, data=None):
+        if inPy3k:
+            from urllib.parse import urlencode, urlsplit
+            from http.client import HTTPException
+        else:
+            from urllib import urlencode
+            from urlparse import urlsplit
+            from httplib import HTTPException
+        scheme, host, path = urlsplit(url)[:3]
+        if params:
+            url = '%s?%s' % (url, urlencode(params))
+            path = '%s?%s' % (path, urlencode(params))
+        headers = {}
+        body = None
+        if data:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        # A kept-alive connection may have been closed by the server since the
+        # last call, in which case it is reopened once. Only errors showing the
+        # old connection was already dropped are retried, anything else (a
+        # timeout say) may come after the server got the request, and sending
+        # it again could register a domain twice. Other failures are left to
+        # attempts_count.
+        while True:
+            reused = getattr(self._local, 'key', None) == (scheme, host)
+            connection = self._connection(scheme, host)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (HTTPException, IOError) as e:
+                self.close()
+                if not (reused and self._is_dropped_connection(e)):
+                    if isinstance(e, IOError):
+                        raise
+                    # callers only need to catch IOError, as with requests
+                    raise IOError('%s: %s' % (type(e).__name__, e))
+        charset = 'utf-8'
+        content_type = response.getheader('Content-Type') or ''
+        if 'charset=' in content_type:
+            charset = content_type.split('charset=')[-1].split(';')[0].strip()
+        return self.Response(response.status, content.decode(charset), url)
+
+
 class Api(object):
     # Follows API spec capitalization in variable names for consistency.
     def __init__(self, ApiUser, ApiKey, UserName, ClientIP,
                  sandbox=True, debug=True,
                  attempts_count=DEFAULT_ATTEMPTS_COUNT,
-                 attempts_delay=DEFAULT_ATTEMPTS_DELAY):
+                 attempts_delay=DEFAULT_ATTEMPTS_DELAY,
+                 throttle=None, transport=None):
         self.ApiUser = ApiUser
         self.ApiKey = ApiKey
         self.UserName = UserName
         self.ClientIP = ClientIP
         self.endpoint = ENDPOINTS['sandbox' if sandbox else 'production']
-        self.debug = debug
+        self.debug = debug  # log requests and responses at DEBUG level to the "namecheap" logger
+        self.debug_body_limit = DEFAULT_DEBUG_BODY_LIMIT
         self.payload_limit = 10  # After hitting this lenght limit script will move payload from POST params to POST data
         self.attempts_count = attempts_count
         self.attempts_delay = attempts_delay
+        self.throttle = throttle  # Throttle instance, or None to not limit calls
+        self._bulk_throttle = None  # default Throttle of the bulk methods, made when first needed
+        self.requests_count = 0  # HTTP requests sent, retries included
+        self.errors_count = 0  # calls that failed with ApiError or a connection error
+        self.transport = transport or RequestsTransport()
 
     # https://www.namecheap.com/support/api/methods/domains/create.aspx
     def domains_create(
@@ -106,28 +309,39 @@ class Api(object):
 
     def _fetch_xml(self, payload, extra_payload = None):
         """Make network call and return parsed XML element"""
+        try:
+            return self._fetch_xml_attempts(payload, extra_payload)
+        except (ApiError, IOError):
+            self._count('errors_count')
+            raise
+
+    def _count(self, counter):
+        with _count_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _fetch_xml_attempts(self, payload, extra_payload):
         attempts_left = self.attempts_count
         while attempts_left > 0:
+            if self.throttle:
+                self.throttle.acquire()
+            self._count('requests_count')
             if extra_payload:
-                r = requests.post(self.endpoint, params=payload, data=extra_payload)
+                r = self.transport(self.endpoint, params=payload, data=extra_payload)
             else:
-                r = requests.post(self.endpoint, params=payload)
+                r = self.transport(self.endpoint, params=payload)
             if 200 <= r.status_code <= 299:
                 break
             if attempts_left <= 1:
                 # Here we provide 1 error code which is not present in official docs
                 raise ApiError('1', 'Did not receive 200 (Ok) response')
             if self.debug:
-                print('Received status %d ... retrying ...' % (r.status_code))
+                log.info('Received status %d ... retrying ...', r.status_code,
+                         extra={'event': 'retry', 'status': r.status_code})
             time.sleep(self.attempts_delay)
             attempts_left -= 1
 
-        if self.debug:
-            print("--- Request ---")
-            print(r.url)
-            print(extra_payload)
-            print("--- Response ---")
-            print(r.text)
+        if self.debug and log.isEnabledFor(logging.DEBUG):
+            self._log_exchange(r, payload, extra_payload)
         xml = fromstring(r.text)
 
         if xml.attrib['Status'] == 'ERROR':
@@ -138,6 +352,22 @@ class Api(object):
 
         return xml
 
+    def _log_exchange(self, r, payload, extra_payload):
+        """Log one request and its response, with the ApiKey redacted and
+        the response body cut to debug_body_limit characters"""
+        body = r.text
+        if self.debug_body_limit is not None and len(body) > self.debug_body_limit:
+            body = '%s... (%d more characters)' % (body[:self.debug_body_limit], len(body) - self.debug_body_limit)
+        log.debug("--- Request ---\n%s\n%s\n--- Response ---\n%s",
+                  self._redact(r.url), extra_payload, body,
+                  extra={'event': 'exchange', 'command': payload.get('Command'),
+                         'status': r.status_code, 'response_length': len(r.text)})
+
+    @classmethod
+    def _redact(cls, url):
+        """Hide the ApiKey query argument of a request URL"""
+        return re.sub(r'(ApiKey=)[^&]*', r'\1***', url)
+
     def _call(self, Command, extra_payload={}):
         """Call an API command"""
         payload, extra_payload = self._payload(Command, extra_payload)
@@ -147,19 +377,27 @@ class Api(object):
     class LazyGetListIterator(object):
         """When listing domain names, only one page is returned
         initially. The list needs to be paged through to see all.
-        This iterator gets the next page when necessary."""
+        This iterator gets the next page when necessary, and stops
+        once the total item count reported by the API has been seen."""
         def _get_more_results(self):
             xml = self.api._fetch_xml(self.payload)
             xpath = './/{%(ns)s}CommandResponse/{%(ns)s}DomainGetListResult/{%(ns)s}Domain' % {'ns': NAMESPACE}
             domains = xml.findall(xpath)
             for domain in domains:
                 self.results.append(domain.attrib)
+            xpath = './/{%(ns)s}CommandResponse/{%(ns)s}Paging/{%(ns)s}TotalItems' % {'ns': NAMESPACE}
+            total = xml.find(xpath)
+            if total is not None and total.text:
+                self.total = int(total.text)
+            if not domains:
+                self.total = len(self.results)
             self.payload['Page'] += 1
 
         def __init__(self, api, payload):
             self.api = api
             self.payload = payload
             self.results = []
+            self.total = None
             self.i = -1
 
         def __iter__(self):
@@ -167,7 +405,7 @@ class Api(object):
 
         def __next__(self):
             self.i += 1
-            if self.i >= len(self.results):
+            if self.i >= len(self.results) and (self.total is None or len(self.results) < self.total):
                 self._get_more_results()
 
             if self.i >= len(self.results):
@@ -279,6 +517,26 @@ class Api(object):
 
         return host_record
 
+    @classmethod
+    def _normalize_host_record(cls, host_record):
+        """Brings a host record from either domains_dns_getHosts or the
+        setHosts format to the setHosts format, with defaults filled in and
+        every value a string, so that records can be compared."""
+        record = dict(DEFAULT_HOST_RECORD)
+        record.update((k, v) for k, v in cls._elements_names_fix(dict(host_record)).items() if v is not None)
+        record_type = str(record['RecordType']).upper()
+        address = str(record['Address'])
+        if record_type in HOSTNAME_RECORD_TYPES:
+            # hostnames are the same with or without the root dot, in any case
+            address = address.rstrip('.').lower()
+        return {
+            'HostName': str(record['HostName']).lower(),
+            'RecordType': record_type,
+            'Address': address,
+            'MXPref': str(record['MXPref']),
+            'TTL': str(record['TTL'])
+        }
+
     # https://www.namecheap.com/support/api/methods/domains/get-contacts.aspx
     def domains_getContacts(self, DomainName):
         """Gets contact information for the requested domain.
@@ -333,12 +591,34 @@ class Api(object):
 
         api.domains_dns_setCustom('example.com', { 'Nameservers' : 'ns1.example.com,ns2.example.com' })"""
 
-        extra_payload = host_records
+        extra_payload = dict(host_records)
         sld, tld = domain.split(".")
         extra_payload['SLD'] = sld
         extra_payload['TLD'] = tld
         self._call("namecheap.domains.dns.setCustom", extra_payload)
 
+    # https://www.namecheap.com/support/api/methods/domains-dns/get-list.aspx
+    def domains_dns_getList(self, domain):
+        """Gets the nameservers a domain is using.
+
+        Returns a dict like
+        {
+            'IsUsingOurDNS': False,
+            'Nameservers': ['ns1.example.com', 'ns2.example.com']
+        }"""
+        sld, tld = domain.split(".")
+        extra_payload = {
+            'SLD': sld,
+            'TLD': tld
+        }
+        xml = self._call("namecheap.domains.dns.getList", extra_payload)
+        xpath = './/{%(ns)s}CommandResponse/{%(ns)s}DomainDNSGetListResult' % {'ns': NAMESPACE}
+        result = xml.find(xpath)
+        return {
+            'IsUsingOurDNS': result.attrib.get('IsUsingOurDNS') == 'true',
+            'Nameservers': [ns.text for ns in result.findall('{%s}Nameserver' % NAMESPACE)]
+        }
+
     # https://www.namecheap.com/support/api/methods/domains-dns/get-hosts.aspx
     def domains_dns_getHosts(self, domain):
         """Retrieves DNS host record settings. Note that the key names are different from those
@@ -372,12 +652,12 @@ class Api(object):
         """
         host_records_remote = self.domains_dns_getHosts(domain)
 
-        print("Remote: %i" % len(host_records_remote))
+        log.debug("Remote: %i", len(host_records_remote))
 
         host_records_remote.append(host_record)
         host_records_remote = [self._elements_names_fix(x) for x in host_records_remote]
 
-        print("To set: %i" % len(host_records_remote))
+        log.debug("To set: %i", len(host_records_remote))
 
         extra_payload = self._list_of_dictionaries_to_numbered_payload(host_records_remote)
         sld, tld = domain.split(".")
@@ -402,7 +682,7 @@ class Api(object):
         """
         host_records_remote = self.domains_dns_getHosts(domain)
 
-        print("Remote: %i" % len(host_records_remote))
+        log.debug("Remote: %i", len(host_records_remote))
 
         host_records_new = []
         for r in host_records_remote:
@@ -418,15 +698,14 @@ class Api(object):
 
         host_records_new = [self._elements_names_fix(x) for x in host_records_new]
 
-        print("To set: %i" % len(host_records_new))
+        log.debug("To set: %i", len(host_records_new))
 
         # Check that we delete not more than 1 record at a time
         if len(host_records_remote) != len(host_records_new) + 1:
-            sys.stderr.write(
-                "Something went wrong while removing host record, delta > 1: %i -> %i, aborting API call.\n" % (
-                    len(host_records_remote),
-                    len(host_records_new)
-                )
+            log.error(
+                "Something went wrong while removing host record, delta > 1: %i -> %i, aborting API call.",
+                len(host_records_remote),
+                len(host_records_new)
             )
             return False
 
@@ -453,19 +732,477 @@ class Api(object):
             'IsExpired': 'false',
             'WhoisGuard': 'NOTPRESENT'
         }
+
+        Pages are fetched GETLIST_MAX_PAGE_SIZE domains at a time unless
+        PageSize says otherwise.
         """
 
         # The payload is a dict of GET args that is passed to
         # the lazy-loading iterator so that it can know how to
         # get more results.
-        extra_payload = {'Page': 1}
+        extra_payload = {'Page': 1, 'PageSize': PageSize or GETLIST_MAX_PAGE_SIZE}
         if ListType:
             extra_payload['ListType'] = ListType
         if SearchTerm:
             extra_payload['SearchTerm'] = SearchTerm
-        if PageSize:
-            extra_payload['PageSize'] = PageSize
         if SortBy:
             extra_payload['SortBy'] = SortBy
         payload, extra_payload = self._payload('namecheap.domains.getList', extra_payload)
         return self.LazyGetListIterator(self, payload)
+
+    def domains_query(self, expiring=False, expired=None, contains=None, tld=None, sort_by=None, where=None):
+        """Lists domains matching all of the given conditions, as a generator of
+        the same dicts domains_getList returns. Conditions the API can filter on
+        are sent along with the request, the rest are checked here while pages
+        are streamed in.
+
+        expiring=True  only domains Namecheap lists as expiring soon
+        expired        True for only expired domains, False to leave them out
+        contains       text the domain name must contain
+        tld            top level domain the name must end in, like 'com'
+        sort_by        one of GETLIST_SORT_BY, such as 'EXPIREDATE'
+        where          function taking a domain dict, returning True to keep it
+
+        Example:
+
+        for domain in api.domains_query(expiring=True, tld='com', sort_by='EXPIREDATE'):
+            print(domain['Name'], domain['Expires'])
+        """
+        if sort_by is not None and sort_by.upper() not in GETLIST_SORT_BY:
+            raise ValueError('sort_by must be one of %s' % ', '.join(GETLIST_SORT_BY))
+
+        if expiring and expired:
+            raise ValueError('expiring and expired can not both be asked for')
+
+        # Filters the API can apply itself
+        ListType = None
+        if expired:
+            ListType = 'EXPIRED'
+        elif expiring:
+            ListType = 'EXPIRING'
+
+        checks = []
+        if expired is False:
+            checks.append(lambda domain: domain['IsExpired'] == 'false')
+        if contains:
+            contains = contains.lower()
+            checks.append(lambda domain: contains in domain['Name'].lower())
+        if tld:
+            suffix = '.' + tld.lower().lstrip('.')
+            checks.append(lambda domain: domain['Name'].lower().endswith(suffix))
+        if where:
+            checks.append(where)
+
+        domains = self.domains_getList(ListType=ListType, SearchTerm=contains,
+                                       SortBy=sort_by and sort_by.upper())
+        return (domain for domain in domains if all(check(domain) for check in checks))
+
+    def domains_dns_setNameservers(self, domains, nameservers=None, threads=4, rollback_on_error=False):
+        """This method is absent in original API. Points many domains at the given
+        list of nameservers with domains_dns_setCustom, or back to Namecheap's own
+        DNS with domains_dns_setDefault when nameservers is None. Domains already
+        set that way are left alone, the rest are changed from several threads,
+        waiting on the Api throttle. An Api without a throttle uses a default
+        Throttle for its bulk methods only, the same one every time, so other
+        calls stay unthrottled.
+
+        Returns one dict per domain, for example
+        {
+            'Domain': 'example.com',
+            'Status': 'changed',  # or 'unchanged' or 'failed'
+            'Before': {'IsUsingOurDNS': True, 'Nameservers': [...]},
+            'Error': None  # the exception if the domain failed
+        }
+        Any exception for one domain, such as ApiError, a connection error or a
+        ValueError for a name like 'example.co.uk', only fails that domain.
+        Passing that list to domains_dns_restoreNameservers undoes the changes,
+        which rollback_on_error=True does by itself if any domain failed. The
+        changed domains are then reported as 'rolled_back', or 'rollback_failed'
+        with the Error of the rollback.
+
+        Example:
+
+        report = api.domains_dns_setNameservers(['example.com', 'example.org'],
+                                                ['ns1.example.net', 'ns2.example.net'])
+        """
+        report = self._set_nameservers_bulk([(domain, nameservers) for domain in domains], threads)
+        if rollback_on_error and any(entry['Status'] == 'failed' for entry in report):
+            restored = dict((entry['Domain'], entry) for entry in self.domains_dns_restoreNameservers(report, threads))
+            for entry in report:
+                if entry['Domain'] in restored:
+                    if restored[entry['Domain']]['Status'] == 'failed':
+                        entry['Status'] = 'rollback_failed'
+                        entry['Error'] = restored[entry['Domain']]['Error']
+                    else:
+                        entry['Status'] = 'rolled_back'
+        return report
+
+    def domains_dns_restoreNameservers(self, report, threads=4):
+        """Puts back the nameservers recorded as 'Before' for every domain
+        domains_dns_setNameservers changed. Returns a report of its own.
+        Throttled the same way as domains_dns_setNameservers."""
+        targets = []
+        for entry in report:
+            if entry['Status'] == 'changed':
+                before = entry['Before']
+                targets.append((entry['Domain'], None if before['IsUsingOurDNS'] else before['Nameservers']))
+        return self._set_nameservers_bulk(targets, threads)
+
+    def _set_nameservers_bulk(self, targets, threads):
+        return self._thread_map(lambda api, target: api._set_nameservers(*target), targets, threads)
+
+    def _thread_map(self, func, items, threads):
+        """Runs func(api, item) for every item from several threads, waiting
+        on the Api throttle. Without one, a copy of the Api waits on a default
+        Throttle kept for bulk calls, so that bulk calls made one after another
+        share the same budget without throttling anything else."""
+        api = self
+        if api.throttle is None:
+            with _bulk_throttle_lock:
+                if self._bulk_throttle is None:
+                    self._bulk_throttle = Throttle()
+            api = copy.copy(self)
+            api.throttle = self._bulk_throttle
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(lambda item: func(api, item), items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _set_nameservers(self, domain, nameservers):
+        entry = {'Domain': domain, 'Status': 'unchanged', 'Before': None, 'Error': None}
+        try:
+            before = entry['Before'] = self.domains_dns_getList(domain)
+            if self._nameservers_match(before, nameservers):
+                return entry
+            if nameservers:
+                self.domains_dns_setCustom(domain, {'Nameservers': ','.join(nameservers)})
+            else:
+                self.domains_dns_setDefault(domain)
+            entry['Status'] = 'changed'
+        # One domain must not stop the others, or the report of what has
+        # already been changed would be lost
+        except Exception as e:
+            entry['Status'] = 'failed'
+            entry['Error'] = e
+        return entry
+
+    @classmethod
+    def _nameservers_match(cls, state, nameservers):
+        """Whether a domains_dns_getList result already uses the nameservers"""
+        if not nameservers:
+            return state['IsUsingOurDNS']
+
+        def normalize(names):
+            return sorted(name.lower().rstrip('.') for name in names)
+        return not state['IsUsingOurDNS'] and normalize(state['Nameservers']) == normalize(nameservers)
+
+    def domains_dns_plan(self, desired, threads=4):
+        """This method is absent in original API. Compares the host records
+        wanted for many domains to what is set now, fetching the current records
+        from several threads.
+
+        desired maps domain names to lists of host records, in the format of
+        either domains_dns_setHosts or domains_dns_getHosts. Missing TTL and
+        MXPref count as Namecheap's defaults. Throttled like
+        domains_dns_setNameservers.
+
+        Returns one dict per domain, for example
+        {
+            'Domain': 'example.com',
+            'Status': 'update',  # or 'unchanged' or 'failed'
+            'Add': [...],  # records to be created
+            'Remove': [...],  # records to be deleted
+            'Records': [...],  # full list to pass to domains_dns_setHosts
+            'Error': None  # the exception if the domain could not be planned
+        }
+        which can be reviewed, then passed to domains_dns_apply. A domain fails
+        on its own, whether the API or connection fails, its name can not be
+        split like 'example.co.uk', or one of its records lacks a field.
+
+        Example:
+
+        plan = api.domains_dns_plan({
+            'example.com': [{'HostName': '@', 'RecordType': 'A', 'Address': '1.2.3.4'}]
+        })
+        api.domains_dns_apply(plan)
+        """
+        return self._thread_map(lambda api, item: api._plan_hosts(*item), list(desired.items()), threads)
+
+    def domains_dns_apply(self, plan, threads=4):
+        """Calls domains_dns_setHosts for the domains in a domains_dns_plan
+        result that need an update, from several threads. Returns the entries
+        for those domains with Status set to 'updated', or 'failed' with the
+        exception as Error."""
+        return self._thread_map(
+            lambda api, entry: api._apply_hosts(entry),
+            [entry for entry in plan if entry['Status'] == 'update'],
+            threads
+        )
+
+    def _plan_hosts(self, domain, host_records):
+        entry = {'Domain': domain, 'Status': 'unchanged', 'Add': [], 'Remove': [], 'Records': None, 'Error': None}
+        # One domain must not stop the plan for the others
+        try:
+            desired = [self._normalize_host_record(x) for x in host_records]
+            current = [self._normalize_host_record(x) for x in self.domains_dns_getHosts(domain)]
+        except Exception as e:
+            entry['Status'] = 'failed'
+            entry['Error'] = e
+            return entry
+
+        def key(record):
+            return tuple(sorted(record.items()))
+        missing = collections.Counter(key(x) for x in desired)
+        missing.subtract(key(x) for x in current)
+        entry['Add'] = [dict(k) for k, n in missing.items() for i in range(n)]
+        entry['Remove'] = [dict(k) for k, n in missing.items() for i in range(-n)]
+        entry['Records'] = desired
+        if entry['Add'] or entry['Remove']:
+            entry['Status'] = 'update'
+        return entry
+
+    def _apply_hosts(self, entry):
+        entry = dict(entry)
+        try:
+            self.domains_dns_setHosts(entry['Domain'], entry['Records'])
+            entry['Status'] = 'updated'
+        # or the results of the zones already set would be lost
+        except Exception as e:
+            entry['Status'] = 'failed'
+            entry['Error'] = e
+        return entry
+
+    def domains_sweep(self, func, domains=None, processes=None, throttle=None, **kwargs):
+        """Runs func(api, domain) for many domains in a pool of worker processes,
+        yielding (domain, result) pairs as they finish, in no particular order.
+        Meant for CPU heavy work over the whole account, like validating every
+        zone, where a single process would be held back by the GIL.
+
+        func must be a module level function so that it can be pickled. The
+        domain names default to everything from domains_getList(**kwargs).
+        All workers draw from one SharedThrottle, so together they stay within
+        the account's rate limit. A plain Throttle given as throttle is turned
+        into a SharedThrottle with the same limits. Calls made by this process,
+        including listing the domains, are not counted against that shared
+        budget. If func raises an exception for a domain, such as ApiError or an
+        IOError from the connection, the exception is yielded as the result
+        instead of stopping the sweep.
+
+        Example:
+
+        def count_hosts(api, domain):
+            return len(api.domains_dns_getHosts(domain))
+
+        for domain, count in api.domains_sweep(count_hosts, processes=4):
+            print(domain, count)
+        """
+        if throttle is None:
+            throttle = SharedThrottle()
+        elif not isinstance(throttle, SharedThrottle):
+            if not isinstance(throttle, Throttle):
+                raise TypeError('throttle must be a Throttle, not %r' % (throttle,))
+            # A plain Throttle would be copied into every worker, each
+            # getting the full budget to itself
+            throttle = SharedThrottle(throttle.limits)
+        if domains is None:
+            domains = [domain['Name'] for domain in self.domains_getList(**kwargs)]
+        return self._sweep(func, domains, processes, throttle)
+
+    def _sweep(self, func, domains, processes, throttle):
+        # The throttle has to be inherited by the workers rather than pickled
+        # with the Api, so it is passed on separately.
+        api = copy.copy(self)
+        api.throttle = api._bulk_throttle = None
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _sweep_init, (api, throttle))
+        try:
+            for result in pool.imap_unordered(_sweep_call, [(func, domain) for domain in domains]):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+# Guards the request and error counters of every Api
+_count_lock = threading.Lock()
+
+# Guards creating the default throttle of Api bulk methods
+_bulk_throttle_lock = threading.Lock()
+
+# Per process Api used by the domains_sweep workers
+_sweep_api = None
+
+
+def _sweep_init(api, throttle):
+    global _sweep_api
+    api.throttle = throttle
+    _sweep_api = api
+
+
+def _sweep_call(args):
+    func, domain = args
+    try:
+        return domain, func(_sweep_api, domain)
+    except Exception as e:
+        return domain, e
+
+
+class ApiPool(object):
+    """Spreads calls over several Namecheap accounts, each an Api instance
+    with its own throttle. domains_check goes to whichever account has the
+    most budget left, and if that account is rate limited or its credentials
+    are rejected it is left out for a cooldown and the next one is tried.
+    Calls about one domain, like domains_dns_setHosts, go to the account
+    that owns the domain.
+
+    Example:
+
+    pool = ApiPool([
+        Api(user1, key1, user1, ip_address, sandbox=False),
+        Api(user2, key2, user2, ip_address, sandbox=False),
+    ])
+    pool.domains_check(['example.com', 'example.org'])
+    pool.domains_dns_getHosts('example.com')
+    pool.usage()
+    """
+
+    # methods whose first argument is a domain that must belong to the account
+    domain_methods = (
+        'domains_getContacts', 'domains_dns_setDefault', 'domains_dns_setCustom',
+        'domains_dns_getList', 'domains_dns_getHosts', 'domains_dns_setHosts',
+        'domains_dns_addHost', 'domains_dns_delHost',
+    )
+
+    def __init__(self, apis, cooldown=DEFAULT_POOL_COOLDOWN):
+        self.apis = list(apis)
+        if not self.apis:
+            raise ValueError('ApiPool needs at least one Api')
+        for api in self.apis:
+            if api.throttle is None:
+                api.throttle = Throttle()
+        self.cooldown = cooldown
+        self.owners = {}  # domain name -> Api of the account owning it
+        self._lock = threading.Lock()
+        self._usage = [{'failovers': 0, 'disabled_until': 0} for api in self.apis]
+
+    def usage(self):
+        """Returns a list with one dict per account, for example
+        {
+            'ApiUser': 'someone',
+            'requests': 120,  # HTTP requests sent, from Api.requests_count
+            'errors': 2,  # failed calls, from Api.errors_count
+            'failovers': 1,  # times the account was left out after an error
+            'remaining': 43.5,  # calls that can be made without waiting
+            'available': True  # False while cooling down after an error
+        }"""
+        now = time.time()
+        with self._lock:
+            return [{
+                'ApiUser': api.ApiUser,
+                'requests': api.requests_count,
+                'errors': api.errors_count,
+                'failovers': usage['failovers'],
+                'remaining': api.throttle.remaining(),
+                'available': usage['disabled_until'] <= now,
+            } for api, usage in zip(self.apis, self._usage)]
+
+    def _failed(self, api, error):
+        """Leaves the account out for a cooldown if the error calls for it"""
+        if error.number in POOL_FAILOVER_ERRORS:
+            with self._lock:
+                usage = self._usage[self.apis.index(api)]
+                usage['failovers'] += 1
+                usage['disabled_until'] = time.time() + self.cooldown
+
+    def _pick(self, exclude):
+        """The account with the most budget left, preferring ones not cooling down"""
+        now = time.time()
+        with self._lock:
+            candidates = [(usage['disabled_until'] > now, -api.throttle.remaining(), i)
+                          for i, (api, usage) in enumerate(zip(self.apis, self._usage))
+                          if api not in exclude]
+        if not candidates:
+            return None
+        return self.apis[min(candidates)[2]]
+
+    def _call(self, api, func):
+        """Returns func(api), cooling the account down after a failover error"""
+        try:
+            return func(api)
+        except ApiError as e:
+            self._failed(api, e)
+            raise
+
+    def domains_check(self, domains):
+        """Same as Api.domains_check, made from the account with the most budget left"""
+        tried = []
+        while True:
+            api = self._pick(tried)
+            try:
+                return self._call(api, lambda api: api.domains_check(domains))
+            except ApiError as e:
+                if e.number not in POOL_FAILOVER_ERRORS or len(tried) + 1 == len(self.apis):
+                    raise
+                log.info('Account %s failed with %s, trying another', api.ApiUser, e)
+                tried.append(api)
+
+    def domains_getList(self, **kwargs):
+        """Lists the domains of every account in turn, remembering which
+        account owns each one"""
+        for api in self.apis:
+            try:
+                for domain in api.domains_getList(**kwargs):
+                    with self._lock:
+                        self.owners[domain['Name'].lower()] = api
+                    yield domain
+            except ApiError as e:
+                self._failed(api, e)
+                raise
+
+    def owner(self, domain):
+        """Returns the Api of the account that owns the domain, searching
+        the accounts' domain lists the first time a domain is asked about"""
+        domain = domain.lower()
+        with self._lock:
+            api = self.owners.get(domain)
+        if api is not None:
+            return api
+
+        # Accounts cooling down after an error, or failing now, are skipped
+        now = time.time()
+        with self._lock:
+            reachable = [api for api, usage in zip(self.apis, self._usage) if usage['disabled_until'] <= now]
+        error = None
+        for api in reachable:
+            try:
+                names = self._call(api, lambda api: [
+                    found['Name'].lower() for found in api.domains_getList(SearchTerm=domain.split('.')[0])
+                ])
+            except ApiError as e:
+                if e.number not in POOL_FAILOVER_ERRORS:
+                    raise
+                log.info('Account %s failed with %s, trying another', api.ApiUser, e)
+                error = e
+                continue
+            if domain in names:
+                with self._lock:
+                    self.owners[domain] = api
+                return api
+        if error is not None:
+            # the domain may well be in the account that failed
+            raise error
+        # Namecheap's own error for a domain that is not in the account
+        raise ApiError('2019166', 'Domain not found in any reachable account: %s' % domain)
+
+    def __getattr__(self, name):
+        if name not in self.domain_methods:
+            raise AttributeError(name)
+
+        def call(domain, *args, **kwargs):
+            return self._call(self.owner(domain), lambda api: getattr(api, name)(domain, *args, **kwargs))
+        call.__name__ = name
+        call.__doc__ = getattr(Api, name).__doc__
+        return call
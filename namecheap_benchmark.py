@@ -0,0 +1,24 @@
+# Run "python namecheap_benchmark.py" to see how long "import namecheap" takes
+# in a fresh interpreter, compared to also importing requests the way the
+# module used to at load time.
+import subprocess
+import sys
+import time
+
+RUNS = 20
+
+
+def median_import_time(statement):
+    timings = []
+    for i in range(RUNS):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement])
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+if __name__ == '__main__':
+    baseline = median_import_time('pass')
+    for statement in ('import namecheap', 'import namecheap, requests'):
+        print('%-30s %6.1f ms' % (statement, (median_import_time(statement) - baseline) * 1000))
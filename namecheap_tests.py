@@ -1,5 +1,6 @@
 # Run "nosetests" on command line to run these.
-from namecheap import Api, ApiError
+import logging
+from namecheap import Api, ApiPool, ApiError, Throttle, SharedThrottle, HTTPTransport
 from nose.tools import *  # pip install nose
 
 api_key = ''  # You create this on Namecheap site
@@ -304,3 +305,534 @@ def test_list_of_dictionaries_to_numbered_payload():
     }
 
     assert_equal(result, expected_result)
+
+
+def test_throttle_remaining():
+    throttle = Throttle([(5, 3600)])
+    for i in range(3):
+        throttle.acquire()
+    assert_equal(int(throttle.remaining()), 2)
+
+
+def test_throttle_multiple_limits():
+    throttle = Throttle([(5, 60), (2, 3600)])
+    throttle.acquire()
+    assert_equal(int(throttle.remaining()), 1)
+    throttle.acquire()
+    assert_equal(int(throttle.remaining()), 0)
+
+
+def test_shared_throttle_remaining():
+    throttle = SharedThrottle([(5, 3600)])
+    throttle.acquire()
+    assert_equal(int(throttle.remaining()), 4)
+
+
+def domain_length(api, domain):
+    return len(domain)
+
+
+def test_domains_sweep():
+    api = Api(username, api_key, username, ip_address, sandbox=True)
+    domains = ['a.com', 'bb.com', 'ccc.com']
+    results = dict(api.domains_sweep(domain_length, domains=domains, processes=2))
+    assert_equal(results, {'a.com': 5, 'bb.com': 6, 'ccc.com': 7})
+
+
+def failing_for_co_uk(api, domain):
+    if domain.endswith('.co.uk'):
+        raise ValueError(domain)
+    if domain == 'offline.com':
+        raise IOError('Connection refused')
+    return len(domain)
+
+
+def test_domains_sweep_yields_errors():
+    api = Api(username, api_key, username, ip_address, sandbox=True)
+    results = dict(api.domains_sweep(failing_for_co_uk, domains=['a.com', 'x.co.uk', 'offline.com'], processes=2))
+    assert_equal(results['a.com'], 5)
+    assert_true(isinstance(results['x.co.uk'], ValueError))
+    assert_true(isinstance(results['offline.com'], IOError))
+
+
+def throttle_class(api, domain):
+    return type(api.throttle).__name__
+
+
+def test_domains_sweep_shares_plain_throttle():
+    api = Api(username, api_key, username, ip_address, sandbox=True)
+    results = api.domains_sweep(throttle_class, domains=['a.com'], throttle=Throttle([(5, 60)]))
+    assert_equal(list(results), [('a.com', 'SharedThrottle')])
+    assert_raises(TypeError, api.domains_sweep, domain_length, domains=['a.com'], throttle=5)
+
+
+def test_redact():
+    url = 'https://api.sandbox.namecheap.com/xml.response?ApiUser=u&ApiKey=secret&Command=x'
+    assert_equal(
+        Api._redact(url),
+        'https://api.sandbox.namecheap.com/xml.response?ApiUser=u&ApiKey=***&Command=x'
+    )
+
+
+def ok_response(inner_xml):
+    """Wraps the XML of a command's result the way the API does"""
+    return (
+        '<ApiResponse Status="OK" xmlns="http://api.namecheap.com/xml.response">'
+        '<CommandResponse>%s</CommandResponse></ApiResponse>' % inner_xml
+    )
+
+
+def error_response(number, text):
+    return (
+        '<ApiResponse Status="ERROR" xmlns="http://api.namecheap.com/xml.response">'
+        '<Errors><Error Number="%s">%s</Error></Errors></ApiResponse>' % (number, text)
+    )
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, text, url):
+        self.text = text
+        self.url = url
+
+
+class FakeApi(Api):
+    """Api whose transport answers from memory instead of the network.
+    Subclasses implement respond(Command, args), returning the XML inside
+    CommandResponse or raising ApiError. args holds every parameter sent
+    except the credentials and Command. Requests are kept in self.requests."""
+    def __init__(self, *args, **kwargs):
+        kwargs['transport'] = self._answer
+        Api.__init__(self, *args, **kwargs)
+        self.requests = []
+
+    def _answer(self, url, params=None, data=None):
+        args = dict(params)
+        args.update(data or {})
+        for key in ('ApiUser', 'ApiKey', 'UserName', 'ClientIP'):
+            del args[key]
+        Command = args.pop('Command')
+        self.requests.append((Command, args))
+        try:
+            text = ok_response(self.respond(Command, args))
+        except ApiError as e:
+            text = error_response(e.number, e.text)
+        return FakeResponse(text, url)
+
+
+class CheckApi(FakeApi):
+    """Answers domains.check with a long response"""
+    def respond(self, Command, args):
+        return '<DomainCheckResult Domain="%s" Available="true" Description="%s" />' % (
+            args['DomainList'], 'x' * 5000)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_debug_log_cuts_body():
+    logger = logging.getLogger('namecheap')
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    try:
+        api = CheckApi(username, api_key, username, ip_address, sandbox=True)
+        api.debug_body_limit = 100
+        api.domains_check('example.com')
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+    message = handler.records[0].getMessage()
+    assert_true(len(message) < 500)
+    assert_true(message.endswith('more characters)'))
+    assert_true(handler.records[0].response_length > 5000)
+
+
+def test_debug_log_skipped_when_disabled():
+    logger = logging.getLogger('namecheap')
+    logger.setLevel(logging.INFO)
+    try:
+        api = CheckApi(username, api_key, username, ip_address, sandbox=True)
+        calls = []
+        api._log_exchange = lambda *args: calls.append(args)
+        api.domains_check('example.com')
+        assert_equal(calls, [])
+        logger.setLevel(logging.DEBUG)
+        api.debug = False
+        api.domains_check('example.com')
+        assert_equal(calls, [])
+    finally:
+        logger.setLevel(logging.NOTSET)
+
+
+class GetListApi(FakeApi):
+    """Answers domains.getList from a fixed list"""
+    domains = ['alpha.com', 'beta.net', 'alphabet.org', 'gamma-alpha.com', 'delta.com']
+
+    def respond(self, Command, args):
+        matching = [d for d in self.domains if args.get('SearchTerm', '') in d]
+        start = (args['Page'] - 1) * args['PageSize']
+        page = matching[start:start + args['PageSize']]
+        return (
+            '<DomainGetListResult>%s</DomainGetListResult>'
+            '<Paging><TotalItems>%d</TotalItems></Paging>' % (
+                ''.join('<Domain Name="%s" IsExpired="false" />' % d for d in page),
+                len(matching)
+            )
+        )
+
+
+def test_domains_getList_paging():
+    api = GetListApi(username, api_key, username, ip_address, sandbox=True)
+    names = [d['Name'] for d in api.domains_getList(PageSize=2)]
+    assert_equal(names, GetListApi.domains)
+    assert_equal(len(api.requests), 3)
+
+
+def test_domains_query():
+    api = GetListApi(username, api_key, username, ip_address, sandbox=True)
+    names = [d['Name'] for d in api.domains_query(contains='alpha', tld='com', sort_by='name')]
+    assert_equal(names, ['alpha.com', 'gamma-alpha.com'])
+    assert_equal(len(api.requests), 1)
+    assert_equal(api.requests[0][1]['SearchTerm'], 'alpha')
+    assert_equal(api.requests[0][1]['SortBy'], 'NAME')
+    assert_equal(api.requests[0][1]['PageSize'], 100)
+
+
+class NameserverApi(FakeApi):
+    """Keeps nameserver settings in memory"""
+    def __init__(self, *args, **kwargs):
+        FakeApi.__init__(self, *args, **kwargs)
+        self.nameservers = {
+            'default.com': None,
+            'custom.com': ['ns1.example.net', 'ns2.example.net'],
+            'other.com': ['ns1.other.net', 'ns2.other.net'],
+        }
+        self.failing = set()
+        self.broken = set()  # domains whose connection fails
+        self.failing_commands = set()
+        self.commands = []
+
+    def respond(self, Command, args):
+        domain = args['SLD'] + '.' + args['TLD']
+        self.commands.append((Command, domain))
+        if domain in self.broken:
+            raise IOError('Connection reset by peer')
+        if Command in self.failing_commands or domain in self.failing and Command != 'namecheap.domains.dns.getList':
+            raise ApiError('2019166', 'Domain not found')
+        if Command == 'namecheap.domains.dns.setDefault':
+            self.nameservers[domain] = None
+        elif Command == 'namecheap.domains.dns.setCustom':
+            self.nameservers[domain] = args['Nameservers'].split(',')
+        current = self.nameservers[domain]
+        return '<DomainDNSGetListResult Domain="%s" IsUsingOurDNS="%s">%s</DomainDNSGetListResult>' % (
+            domain,
+            'true' if current is None else 'false',
+            ''.join('<Nameserver>%s</Nameserver>' % ns for ns in current or [])
+        )
+
+
+def test_domains_dns_setCustom_leaves_argument_alone():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    host_records = {'Nameservers': 'ns1.example.net,ns2.example.net'}
+    api.domains_dns_setCustom('default.com', host_records)
+    assert_equal(host_records, {'Nameservers': 'ns1.example.net,ns2.example.net'})
+
+
+def test_domains_dns_setNameservers():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    report = api.domains_dns_setNameservers(
+        ['default.com', 'custom.com', 'other.com'], ['NS2.example.net.', 'ns1.example.net'])
+    assert_equal([entry['Status'] for entry in report], ['changed', 'unchanged', 'changed'])
+    assert_equal(api.nameservers['default.com'], ['NS2.example.net.', 'ns1.example.net'])
+    assert_true(('namecheap.domains.dns.setCustom', 'custom.com') not in api.commands)
+
+
+def test_domains_dns_setNameservers_rollback_on_error():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    api.failing.add('other.com')
+    report = api.domains_dns_setNameservers(['default.com', 'custom.com', 'other.com'], rollback_on_error=True)
+    assert_equal([entry['Status'] for entry in report], ['unchanged', 'rolled_back', 'failed'])
+    assert_equal(api.nameservers['custom.com'], ['ns1.example.net', 'ns2.example.net'])
+    assert_equal(api.nameservers['other.com'], ['ns1.other.net', 'ns2.other.net'])
+
+
+def test_domains_dns_setNameservers_connection_error():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    api.broken.add('other.com')
+    report = api.domains_dns_setNameservers(
+        ['default.com', 'other.com'], ['ns1.example.net', 'ns2.example.net'], rollback_on_error=True)
+    assert_equal([entry['Status'] for entry in report], ['rolled_back', 'failed'])
+    assert_true(isinstance(report[1]['Error'], IOError))
+    assert_equal(api.nameservers['default.com'], None)
+
+
+def test_domains_dns_setNameservers_rollback_failed():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    api.failing.add('other.com')
+    api.failing_commands.add('namecheap.domains.dns.setDefault')
+    report = api.domains_dns_setNameservers(['default.com', 'other.com'], ['ns1.x.net'], rollback_on_error=True)
+    assert_equal([entry['Status'] for entry in report], ['rollback_failed', 'failed'])
+    assert_true(isinstance(report[0]['Error'], ApiError))
+    assert_equal(api.nameservers['default.com'], ['ns1.x.net'])
+
+
+def test_domains_dns_setNameservers_bad_domain_name():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    report = api.domains_dns_setNameservers(['default.com', 'x.co.uk'], ['ns1.a.net'], rollback_on_error=True)
+    assert_equal([entry['Status'] for entry in report], ['rolled_back', 'failed'])
+    assert_true(isinstance(report[1]['Error'], ValueError))
+    assert_equal(api.nameservers['default.com'], None)
+
+
+def test_bulk_calls_share_default_throttle():
+    api = NameserverApi(username, api_key, username, ip_address, sandbox=True)
+    api.domains_dns_setNameservers(['default.com'])
+    throttle = api._bulk_throttle
+    api.domains_dns_setNameservers(['custom.com'])
+    assert_true(api._bulk_throttle is throttle)
+    assert_equal(int(throttle.remaining()), 50 - 3)
+    assert_true(api.throttle is None)
+
+
+class HostsApi(FakeApi):
+    """Keeps host records in memory"""
+    def __init__(self, *args, **kwargs):
+        FakeApi.__init__(self, *args, **kwargs)
+        self.hosts = {
+            'same.com': [{'Name': '@', 'Type': 'A', 'Address': '1.2.3.4', 'MXPref': '10', 'TTL': '1800'}],
+            'stale.com': [{'Name': '@', 'Type': 'A', 'Address': '1.2.3.4', 'MXPref': '10', 'TTL': '1800'}],
+            'alias.com': [{'Name': 'www', 'Type': 'CNAME', 'Address': 'Target.example.com', 'MXPref': '10', 'TTL': '1800'}],
+        }
+        self.set_hosts_calls = []
+
+    def respond(self, Command, args):
+        domain = args['SLD'] + '.' + args['TLD']
+        if domain not in self.hosts:
+            raise ApiError('2019166', 'Domain not found')
+        if Command == 'namecheap.domains.dns.setHosts':
+            self.set_hosts_calls.append(domain)
+            records = []
+            i = 1
+            while 'HostName%d' % i in args:
+                records.append({
+                    'Name': args['HostName%d' % i],
+                    'Type': args['RecordType%d' % i],
+                    'Address': args['Address%d' % i],
+                    'MXPref': args['MXPref%d' % i],
+                    'TTL': args['TTL%d' % i],
+                })
+                i += 1
+            assert_equal(len(args), 2 + 5 * len(records))
+            self.hosts[domain] = records
+        return '<DomainDNSGetHostsResult Domain="%s">%s</DomainDNSGetHostsResult>' % (
+            domain,
+            ''.join('<host HostId="%d" Name="%s" Type="%s" Address="%s" MXPref="%s" TTL="%s" />' % (
+                i, x['Name'], x['Type'], x['Address'], x['MXPref'], x['TTL']
+            ) for i, x in enumerate(self.hosts[domain]))
+        )
+
+
+def test_domains_dns_plan_and_apply():
+    api = HostsApi(username, api_key, username, ip_address, sandbox=True)
+    desired = {
+        'same.com': [{'HostName': '@', 'RecordType': 'a', 'Address': '1.2.3.4', 'TTL': 1800}],
+        'stale.com': [{'HostName': 'www', 'RecordType': 'CNAME', 'Address': 'stale.com.'}],
+        'missing.com': [],
+    }
+    plan = dict((entry['Domain'], entry) for entry in api.domains_dns_plan(desired))
+    assert_equal(plan['same.com']['Status'], 'unchanged')
+    assert_equal(plan['missing.com']['Status'], 'failed')
+    assert_equal(plan['stale.com']['Status'], 'update')
+    assert_equal(plan['stale.com']['Add'], [
+        {'HostName': 'www', 'RecordType': 'CNAME', 'Address': 'stale.com', 'MXPref': '10', 'TTL': '1800'}])
+    assert_equal(plan['stale.com']['Remove'], [
+        {'HostName': '@', 'RecordType': 'A', 'Address': '1.2.3.4', 'MXPref': '10', 'TTL': '1800'}])
+
+    report = api.domains_dns_apply(list(plan.values()))
+    assert_equal([(entry['Domain'], entry['Status']) for entry in report], [('stale.com', 'updated')])
+    assert_equal(api.set_hosts_calls, ['stale.com'])
+    assert_equal(api.hosts['stale.com'], [
+        {'Name': 'www', 'Type': 'CNAME', 'Address': 'stale.com', 'MXPref': '10', 'TTL': '1800'}])
+    assert_equal(api.domains_dns_plan(desired)[1]['Status'], 'unchanged')
+
+
+def test_domains_dns_plan_bad_domains():
+    api = HostsApi(username, api_key, username, ip_address, sandbox=True)
+    desired = {
+        'stale.com': [{'HostName': 'www', 'RecordType': 'A', 'Address': '1.2.3.4'}],
+        'x.co.uk': [],
+        'same.com': [{'HostName': '@', 'Address': '1.2.3.4'}],
+    }
+    plan = dict((entry['Domain'], entry) for entry in api.domains_dns_plan(desired))
+    assert_equal(plan['stale.com']['Status'], 'update')
+    assert_equal(plan['x.co.uk']['Status'], 'failed')
+    assert_true(isinstance(plan['x.co.uk']['Error'], ValueError))
+    assert_equal(plan['same.com']['Status'], 'failed')
+    assert_true(isinstance(plan['same.com']['Error'], KeyError))
+
+    plan['x.co.uk']['Status'] = 'update'  # say it was edited by hand
+    report = dict((entry['Domain'], entry) for entry in api.domains_dns_apply(list(plan.values())))
+    assert_equal(report['stale.com']['Status'], 'updated')
+    assert_equal(report['x.co.uk']['Status'], 'failed')
+
+
+def test_domains_dns_plan_hostname_addresses():
+    api = HostsApi(username, api_key, username, ip_address, sandbox=True)
+    desired = {'alias.com': [{'HostName': 'www', 'RecordType': 'CNAME', 'Address': 'target.example.com.'}]}
+    assert_equal(api.domains_dns_plan(desired)[0]['Status'], 'unchanged')
+
+
+def start_transport_server(behaviour):
+    """Starts a local server answering domains.check. behaviour(handler) is
+    called for every request and may return 'close' to drop the connection
+    after answering without saying so, or 'hang' to not answer at all."""
+    import threading
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            server.requests.append(self.client_address)
+            action = behaviour(self)
+            if action == 'hang':
+                import time
+                time.sleep(1)
+                self.close_connection = True
+                return
+            body = ok_response('<DomainCheckResult Domain="example.com" Available="false" />').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if action == 'close':
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def transport_api(server, timeout=60):
+    api = Api(username, api_key, username, ip_address, sandbox=True, transport=HTTPTransport(timeout))
+    api.endpoint = 'http://127.0.0.1:%d/xml.response' % server.server_port
+    return api
+
+
+def test_http_transport():
+    server = start_transport_server(lambda handler: None)
+    api = transport_api(server)
+    try:
+        assert_equal(api.domains_check('example.com'), False)
+        api.payload_limit = 1  # send the rest as POST data
+        assert_equal(api.domains_check(['example.com']), {'example.com': False})
+        assert_equal(len(set(server.requests)), 1)  # the connection was kept open
+    finally:
+        api.transport.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_transport_reopens_dropped_connection():
+    server = start_transport_server(lambda handler: 'close')
+    api = transport_api(server)
+    try:
+        assert_equal(api.domains_check('example.com'), False)
+        assert_equal(api.domains_check('example.com'), False)
+        assert_equal(len(set(server.requests)), 2)
+    finally:
+        api.transport.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_transport_does_not_resend_after_timeout():
+    server = start_transport_server(lambda handler: 'hang' if len(server.requests) > 1 else None)
+    api = transport_api(server, timeout=0.2)
+    try:
+        assert_equal(api.domains_check('example.com'), False)
+        assert_raises(IOError, api.domains_check, 'example.com')
+        assert_equal(len(server.requests), 2)
+    finally:
+        api.transport.close()
+        server.shutdown()
+        server.server_close()
+
+
+class AccountApi(GetListApi):
+    """One account of an ApiPool, answering from memory"""
+    def __init__(self, user, domains, error=None):
+        GetListApi.__init__(self, user, api_key, user, ip_address, sandbox=True, throttle=Throttle([(10, 3600)]))
+        self.domains = domains
+        self.error = error
+
+    def respond(self, Command, args):
+        if self.error:
+            raise ApiError(self.error, 'Failed')
+        if Command == 'namecheap.domains.check':
+            return ''.join('<DomainCheckResult Domain="%s" Available="%s" />' % (
+                domain, 'false' if domain in self.domains else 'true'
+            ) for domain in args['DomainList'].split(','))
+        if Command == 'namecheap.domains.dns.getHosts':
+            return '<DomainDNSGetHostsResult><host Name="@" Type="A" Address="%s" /></DomainDNSGetHostsResult>' % self.ApiUser
+        return GetListApi.respond(self, Command, args)
+
+
+def test_api_pool_routes_by_budget_and_fails_over():
+    first = AccountApi('first', ['a.com'], error='1011102')
+    second = AccountApi('second', ['b.com'])
+    pool = ApiPool([first, second])
+    assert_equal(pool.domains_check(['a.com']), {'a.com': True})
+    assert_equal(pool.domains_check(['b.com']), {'b.com': False})
+    usage = pool.usage()
+    assert_equal([u['requests'] for u in usage], [1, 2])
+    assert_equal([u['available'] for u in usage], [False, True])
+    assert_equal([u['errors'] for u in usage], [1, 0])
+    assert_equal(int(usage[1]['remaining']), 8)
+
+
+def test_api_pool_routes_by_owner():
+    # enough domains matching the search for 'b' to take two pages
+    second_domains = ['b.com'] + ['b%d.com' % i for i in range(150)]
+    pool = ApiPool([AccountApi('first', ['a.com']), AccountApi('second', second_domains)])
+    assert_equal(pool.domains_dns_getHosts('b.com')[0]['Address'], 'second')
+    assert_equal(pool.domains_dns_getHosts('A.com')[0]['Address'], 'first')
+    assert_raises(ApiError, pool.domains_dns_getHosts, 'c.com')
+    # first: three one page lookups and getHosts, second: two two page
+    # lookups and getHosts
+    assert_equal([u['requests'] for u in pool.usage()], [4, 5])
+    assert_equal([u['errors'] for u in pool.usage()], [0, 0])
+
+
+def test_api_pool_owner_lookup_fails_over():
+    pool = ApiPool([AccountApi('first', ['a.com'], error='1011102'), AccountApi('second', ['b.com'])])
+    assert_equal(pool.domains_dns_getHosts('b.com')[0]['Address'], 'second')
+    usage = pool.usage()
+    assert_equal([u['errors'] for u in usage], [1, 0])
+    assert_equal([u['available'] for u in usage], [False, True])
+    # the failed account is cooling down, so a missing domain is not found
+    assert_raises(ApiError, pool.domains_dns_getHosts, 'a.com')
+    assert_equal(usage[0]['requests'], pool.usage()[0]['requests'])
+
+
+def test_api_pool_needs_accounts():
+    assert_raises(ValueError, ApiPool, [])